@@ -0,0 +1,255 @@
+import os
+import asyncio
+import tracemalloc
+from collections import deque
+from typing import Optional
+
+
+class ImageBudgetExceeded(Exception):
+    """Raised when an image does not fit in the in-flight memory budget right now"""
+
+
+class ImageTooLarge(ImageBudgetExceeded):
+    """Raised when an image could never fit, however idle the server is"""
+
+
+class ImageReservation:
+    """The slice of the image memory budget held by one request"""
+
+    def __init__(self, budget: "ImageMemoryBudget", nbytes: int, label: str):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.label = label
+        # worker thread still using the reserved memory after its request was cancelled
+        self._worker = None
+        budget.reservations += 1
+
+    def resize(self, nbytes: int):
+        """Shrink the reservation to nbytes as buffers are freed"""
+        nbytes = max(int(nbytes), 0)
+        if nbytes > self.nbytes:
+            raise ValueError("resize() only shrinks a reservation, use grow() to enlarge it")
+        if nbytes < self.nbytes:
+            self.budget._release(self.nbytes - nbytes)
+            self.nbytes = nbytes
+
+    async def grow(self, nbytes: int):
+        """Resize the reservation to nbytes, waiting for other requests to free memory if it grows"""
+        nbytes = max(int(nbytes), 0)
+        if nbytes <= self.nbytes:
+            self.resize(nbytes)
+            return
+        self.budget._check_capacity(nbytes, self.label)
+        await self.budget._wait(nbytes - self.nbytes, self.nbytes, self.label)
+        self.nbytes = nbytes
+
+    async def to_thread(self, func, *args, **kwargs):
+        """Run func in a worker thread that uses the reserved memory
+
+        Cancelling the caller does not stop the thread, so if that happens
+        release() and when_idle() callbacks wait for the thread to finish.
+        """
+        worker = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(worker)
+        except asyncio.CancelledError:
+            if not worker.done():
+                self._worker = worker
+                # nobody awaits the thread any more, so retrieve its outcome here
+                worker.add_done_callback(lambda w: w.cancelled() or w.exception())
+            raise
+
+    def when_idle(self, callback):
+        """Call callback now, or once a worker thread of a cancelled request finishes"""
+        if self._worker is None or self._worker.done():
+            callback()
+        else:
+            self._worker.add_done_callback(lambda _: callback())
+
+    def release(self):
+        """Give back the whole reservation (safe to call more than once)"""
+        if self._worker is not None and not self._worker.done():
+            self.when_idle(self.release)
+            return
+        if self.nbytes:
+            self.budget._release(self.nbytes)
+            self.nbytes = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class ImageMemoryBudget:
+    """Global budget for image bytes and decoded pixels held by in-flight requests
+
+    A request reserves its expected peak (download, Vision payload, decoded
+    pixels) before allocating anything and resizes the reservation as each
+    stage finishes. Requests queue in FIFO order once the budget is exhausted
+    and are rejected with ImageBudgetExceeded if they wait longer than
+    max_wait_seconds, or with ImageTooLarge if they could never fit at all.
+
+    Requests that already hold memory and need more (grow) are served before
+    new ones are admitted. If every holder is waiting to grow, nothing can be
+    released any more, so the oldest of them is rejected to break the deadlock.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int,
+        max_image_bytes: int,
+        max_wait_seconds: float = 10.0,
+        trace: bool = False
+    ):
+        self.capacity_bytes = capacity_bytes
+        self.max_image_bytes = max_image_bytes
+        self.max_wait_seconds = max_wait_seconds
+        self.in_use_bytes = 0
+        self.peak_bytes = 0
+        self.reservations = 0
+        self.waits = 0
+        self.rejections = 0
+        self.traced_peak_bytes = 0
+        # queued (extra_bytes, future, held_bytes) for new requests and for growing ones
+        self._waiters = deque()
+        self._growers = deque()
+
+        # tracemalloc only sees Python-heap allocations (downloaded bytes, Vision
+        # payloads), not Pillow's pixel buffers, so it complements the counters above
+        self.trace = trace
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def from_env(cls):
+        mb = 1024 * 1024
+        return cls(
+            capacity_bytes=int(float(os.getenv("IMAGE_MEMORY_BUDGET_MB", "256")) * mb),
+            max_image_bytes=int(float(os.getenv("IMAGE_MAX_MB", "20")) * mb),
+            max_wait_seconds=float(os.getenv("IMAGE_BUDGET_WAIT_SECONDS", "10")),
+            trace=os.getenv("IMAGE_BUDGET_TRACEMALLOC", "").lower() in ("1", "true", "yes")
+        )
+
+    async def acquire(self, nbytes: int, label: str = "image") -> ImageReservation:
+        """Reserve nbytes, waiting for other requests to release memory if needed"""
+        nbytes = max(int(nbytes), 0)
+        self._check_capacity(nbytes, label)
+        await self._wait(nbytes, 0, label)
+        return ImageReservation(self, nbytes, label)
+
+    def _check_capacity(self, nbytes: int, label: str):
+        if nbytes > self.capacity_bytes:
+            self.rejections += 1
+            raise ImageTooLarge(
+                f"{label} needs {nbytes} bytes, more than the whole image memory budget "
+                f"({self.capacity_bytes} bytes)"
+            )
+
+    async def _wait(self, extra: int, held: int, label: str):
+        """Wait until extra bytes are granted to a request already holding held bytes"""
+        queue = self._growers if held else self._waiters
+        # fast path: nobody we would overtake is queued and it fits
+        ahead = self._growers if held else self._growers or self._waiters
+        if not ahead and self.in_use_bytes + extra <= self.capacity_bytes:
+            self._grant(extra)
+            return
+
+        self.waits += 1
+        future = asyncio.get_running_loop().create_future()
+        queue.append((extra, future, held))
+        # a growing request may have been the last one that could still release memory
+        self._wake_waiters()
+        try:
+            await asyncio.wait_for(future, timeout=self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            # the bytes may have been granted in the same loop iteration the timeout fired
+            if future.done() and not future.cancelled() and future.exception() is None:
+                return
+            self.rejections += 1
+            # our slot may have been blocking smaller requests queued behind us
+            self._wake_waiters()
+            raise ImageBudgetExceeded(
+                f"Image memory budget exhausted: waited {self.max_wait_seconds}s for "
+                f"{extra} bytes ({label})"
+            )
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release(extra)
+            else:
+                self._wake_waiters()
+            raise
+
+    def _grant(self, nbytes: int):
+        self.in_use_bytes += nbytes
+        self.peak_bytes = max(self.peak_bytes, self.in_use_bytes)
+
+    def _release(self, nbytes: int):
+        self.in_use_bytes -= nbytes
+        if self.trace:
+            _, traced_peak = tracemalloc.get_traced_memory()
+            self.traced_peak_bytes = max(self.traced_peak_bytes, traced_peak)
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # growing requests first so they can finish and free memory; FIFO within
+        # each queue so large images are not starved by a stream of small ones
+        for queue in (self._growers, self._waiters):
+            while queue:
+                extra, future, _ = queue[0]
+                if future.done():
+                    queue.popleft()
+                    continue
+                if self.in_use_bytes + extra <= self.capacity_bytes:
+                    queue.popleft()
+                    self._grant(extra)
+                    future.set_result(None)
+                    continue
+                if queue is self._growers and self.in_use_bytes <= self._held_by_growers():
+                    queue.popleft()
+                    self.rejections += 1
+                    future.set_exception(ImageBudgetExceeded(
+                        f"Image memory budget exhausted: {extra} more bytes needed while every "
+                        f"in-flight image is waiting for memory"
+                    ))
+                    continue
+                return
+
+    def _held_by_growers(self) -> int:
+        return sum(held for _, future, held in self._growers if not future.done())
+
+    def stats(self, top: Optional[int] = None) -> dict:
+        """Snapshot of budget usage, with tracemalloc figures when tracing is enabled
+
+        top > 0 additionally takes a tracemalloc snapshot and lists the largest
+        allocation sites; it is expensive and exposes source paths.
+        """
+        stats = {
+            "capacity_bytes": self.capacity_bytes,
+            "max_image_bytes": self.max_image_bytes,
+            "in_use_bytes": self.in_use_bytes,
+            "peak_bytes": self.peak_bytes,
+            "queued": sum(
+                1 for _, future, _ in (*self._growers, *self._waiters) if not future.done()
+            ),
+            "reservations": self.reservations,
+            "waits": self.waits,
+            "rejections": self.rejections,
+        }
+        if self.trace and tracemalloc.is_tracing():
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+            self.traced_peak_bytes = max(self.traced_peak_bytes, traced_peak)
+            stats["traced_current_bytes"] = traced_current
+            stats["traced_peak_bytes"] = self.traced_peak_bytes
+            if top:
+                snapshot = tracemalloc.take_snapshot()
+                stats["traced_top"] = [
+                    f"{stat.traceback}: {stat.size} bytes"
+                    for stat in snapshot.statistics("lineno")[:top]
+                ]
+        return stats
+
+
+# shared by every service instance so the limit holds across all requests
+image_budget = ImageMemoryBudget.from_env()
@@ -3,15 +3,69 @@ from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import time
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from models import DishSuggestionRequest, DishRecognitionResponse, DishAnalysisRequest, DishAnalysisResponse
-from services import DishSuggestionService, DishAnalysisService
+from urllib.parse import quote
+from services import DishSuggestionService, DishAnalysisService, sign_gcs_url, GCS_HOST
+from image_budget import image_budget, ImageBudgetExceeded, ImageTooLarge
+from result_cache import result_cache, image_key
+from warmup import request_log, warm_up, popular_queries_from_env, split_sample
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# unsigned URL of the demo image; a signed URL is generated from it for each request
+DEMO_IMAGE_OBJECT_URL = f"https://{GCS_HOST}/junction-2025-woltie/{quote('Zhong Quan -kanaa.jpeg')}"
+
+# report of the last cache warm-up run, if any
+warmup_report = None
+
+
+async def run_cache_warmup():
+    global warmup_report
+    try:
+        # read the log once; the most recent requests are held out of mining to measure hit rate
+        entries = await asyncio.to_thread(request_log.read)
+        mined, sample = split_sample(entries, 500)
+        warmup_report = await warm_up(
+            dish_service,
+            dish_analysis_service,
+            popular_queries_from_env(int(os.getenv("CACHE_WARMUP_TOP_N", "20")), mined),
+            rate_per_second=float(os.getenv("CACHE_WARMUP_RATE", "0.5")),
+            sample=sample,
+            resolve_image_url=sign_gcs_url
+        )
+        print(
+            f"✅ Cache warm-up done: coverage {warmup_report['coverage_rate']}, "
+            f"sample hit rate {warmup_report['sample']['hit_rate']}"
+        )
+    except Exception as e:
+        print(f"⚠️  Cache warm-up failed: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm the result cache in the background so startup is not delayed; the
+    # service calls it replays run Gemini and downloads in worker threads.
+    # Every worker process and instance with CACHE_WARMUP_ON_STARTUP runs its
+    # own warm-up at CACHE_WARMUP_RATE, so N replicas make N times the Gemini
+    # calls; enable it only where a single instance and worker serve traffic
+    warmup_task = None
+    if os.getenv("CACHE_WARMUP_ON_STARTUP", "").lower() in ("1", "true", "yes"):
+        warmup_task = asyncio.create_task(run_cache_warmup())
+    yield
+    if warmup_task:
+        warmup_task.cancel()
+        try:
+            await warmup_task
+        except asyncio.CancelledError:
+            pass
+
+
 # run FastAPI backend using command: fastapi dev main.py
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -36,6 +90,17 @@ dish_analysis_service = DishAnalysisService()
 async def root():
     return {"message": "Woltie API", "status": "running"}
 
+# memory used by in-flight images (tracemalloc figures when IMAGE_BUDGET_TRACEMALLOC is set)
+@app.get("/api/image-budget")
+async def image_budget_stats(top: int = 0):
+    # top allocation sites need a costly snapshot and reveal source paths, so only on request
+    return image_budget.stats(top=top)
+
+# result cache usage and the last warm-up report
+@app.get("/api/cache-stats")
+async def cache_stats():
+    return {"cache": await asyncio.to_thread(result_cache.stats), "warmup": warmup_report}
+
 # endpoint for recognizing dish from user description
 @app.post("/api/recognize-dish", response_model=DishRecognitionResponse)
 async def recognize_dish(request: DishSuggestionRequest):
@@ -54,6 +119,15 @@ async def recognize_dish(request: DishSuggestionRequest):
             request.location,
         )
 
+        # logged requests are mined by the cache warm-up job
+        await asyncio.to_thread(
+            request_log.record,
+            "recognize",
+            description=request.description,
+            location=request.location,
+            dish_name=dish_info.get("dish_name")
+        )
+
         # return dish name, description, nearby restaurants, and confidence score
         return DishRecognitionResponse(
             dish_name=dish_info.get("dish_name", "Unknown Dish"),
@@ -94,28 +168,9 @@ async def analyze_dish():
             print(f"✅ Using demo image URL from environment variable")
         else:
             # Try to generate signed URL from GCS
-            try:
-                from pathlib import Path
-                from google.cloud import storage
-                from google.oauth2 import service_account
-                from datetime import timedelta
-                
-                credentials_path = Path("credentials.json")
-                if credentials_path.exists():
-                    credentials = service_account.Credentials.from_service_account_file(
-                        str(credentials_path)
-                    )
-                    client = storage.Client(credentials=credentials)
-                    bucket = client.bucket("junction-2025-woltie")
-                    blob = bucket.blob("Zhong Quan -kanaa.jpeg")
-                    DEMO_IMAGE_URL = blob.generate_signed_url(
-                        expiration=timedelta(hours=1),
-                        method="GET"
-                    )
-                    print(f"✅ Generated signed URL for demo image")
-            except Exception as e:
-                print(f"⚠️  Could not generate signed URL: {str(e)}")
-                DEMO_IMAGE_URL = None
+            DEMO_IMAGE_URL = await asyncio.to_thread(sign_gcs_url, DEMO_IMAGE_OBJECT_URL)
+            if DEMO_IMAGE_URL:
+                print(f"✅ Generated signed URL for demo image")
         
         # If no image URL available, raise an error
         if not DEMO_IMAGE_URL:
@@ -135,6 +190,14 @@ async def analyze_dish():
             user_preferences=None,
             known_dishes=None
         )
+        await asyncio.to_thread(
+            request_log.record,
+            "analyze",
+            title=DEMO_TITLE,
+            description=DEMO_DESCRIPTION,
+            # signed URLs are bearer credentials: log the object identity, re-signed on replay
+            image_url=image_key(DEMO_IMAGE_URL)
+        )
         
         # calculate processing time
         processing_time = time.time() - start_time
@@ -147,6 +210,18 @@ async def analyze_dish():
         
     except HTTPException:
         raise
+    except ImageTooLarge as e:
+        print(f"❌ Demo request rejected: {str(e)}")
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is too large to analyze: {str(e)}"
+        )
+    except ImageBudgetExceeded as e:
+        print(f"❌ Demo request rejected: {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Server is busy processing other images, please retry: {str(e)}"
+        )
     except Exception as e:
         processing_time = time.time() - start_time
         print(f"❌ Demo request failed after {processing_time:.2f} seconds: {str(e)}")
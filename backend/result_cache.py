@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+def _normalize(part) -> str:
+    """Make equivalent inputs share a cache key (case, whitespace, list order)"""
+    if part is None:
+        return ""
+    if isinstance(part, (list, tuple)):
+        return "|".join(sorted(_normalize(item) for item in part))
+    return " ".join(str(part).lower().split())
+
+
+# query parameters that only carry a URL signature, never the identity of the object
+SIGNING_PARAMS = {"expires", "googleaccessid", "signature"}
+SIGNING_PARAM_PREFIXES = ("x-goog-", "x-amz-")
+
+
+def _is_signing_param(name: str) -> bool:
+    name = name.lower()
+    return name in SIGNING_PARAMS or name.startswith(SIGNING_PARAM_PREFIXES)
+
+
+def image_key(image_url: Optional[str] = None, image_base64: Optional[str] = None) -> str:
+    """Stable identity of a dish image for cache keys and request logs
+
+    Signed URLs change on every request only in their signing parameters, so
+    those are dropped and any other query parameters kept. Inline images are
+    identified by their content hash.
+    """
+    if image_url:
+        scheme, netloc, path, query, _ = urlsplit(image_url)
+        params = [
+            (name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+            if not _is_signing_param(name)
+        ]
+        return urlunsplit((scheme, netloc, path, urlencode(params), ""))
+    if image_base64:
+        return hashlib.sha256(image_base64.encode()).hexdigest()
+    return ""
+
+
+class ResultCache:
+    """Persistent cache of Gemini results, kept in SQLite so it survives restarts
+
+    Only successful model responses are stored; fallback answers produced on
+    errors are never cached. Cache failures are logged and treated as misses.
+
+    The cache is a per-instance file and RESULT_CACHE_PATH must be on local
+    disk. SQLite locking is unreliable on Cloud Storage FUSE and NFS mounts,
+    and writes that fail there are only logged, so never share one file
+    between instances that way. On Cloud Run the local filesystem lives as
+    long as the instance, so the cache is warm per instance.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("RESULT_CACHE_PATH", "result_cache.sqlite3"),
+            ttl_seconds=float(os.getenv("RESULT_CACHE_TTL_HOURS", "168")) * 3600
+        )
+
+    @staticmethod
+    def key(namespace: str, *parts) -> str:
+        digest = hashlib.sha256(
+            json.dumps([_normalize(part) for part in parts]).encode()
+        ).hexdigest()
+        return f"{namespace}:{digest}"
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, namespace TEXT, value TEXT, created_at REAL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _lookup(self, key: str):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def get(self, key: str):
+        """Return the cached value for key, or None on a miss"""
+        try:
+            value = self._lookup(key)
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Warning: result cache lookup failed: {e}")
+            value = None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def contains(self, key: str) -> bool:
+        """Check for a fresh entry without counting a hit or miss"""
+        try:
+            return self._lookup(key) is not None
+        except (sqlite3.Error, ValueError):
+            return False
+
+    def set(self, key: str, value):
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO results (key, namespace, value, created_at) VALUES (?, ?, ?, ?)",
+                    (key, key.split(":", 1)[0], json.dumps(value), time.time())
+                )
+                conn.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Warning: result cache write failed: {e}")
+
+    def stats(self) -> dict:
+        entries = {}
+        try:
+            with self._lock:
+                rows = self._connection().execute(
+                    "SELECT namespace, COUNT(*) FROM results WHERE created_at >= ? GROUP BY namespace",
+                    (time.time() - self.ttl_seconds,)
+                ).fetchall()
+            entries = dict(rows)
+        except sqlite3.Error as e:
+            print(f"Warning: result cache stats failed: {e}")
+
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+# shared by every service instance and the warm-up job
+result_cache = ResultCache.from_env()
@@ -1,17 +1,55 @@
 import os
 import json
 import base64
+import asyncio
 import requests
 from typing import List, Optional
+from urllib.parse import urlsplit, unquote
 from google.cloud import vision
 from google.oauth2 import service_account
 import google.generativeai as genai
 from dotenv import load_dotenv
 from models import RestaurantRecommendation, SimilarDish
+from image_budget import image_budget, ImageBudgetExceeded, ImageTooLarge
+from result_cache import result_cache, image_key
 
 # Load environment variables
 load_dotenv()
 
+# longest edge of images handed to Gemini; larger photos are downscaled while decoding
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))
+# decoded RGBA pixels of an image at that size, reserved up front for every request
+IMAGE_PIXEL_BYTES = IMAGE_MAX_DIMENSION * IMAGE_MAX_DIMENSION * 4
+
+# host of Cloud Storage object URLs, which can be re-signed with the service account
+GCS_HOST = "storage.googleapis.com"
+
+
+def sign_gcs_url(image_url: str, credentials_path: str = "credentials.json") -> Optional[str]:
+    """Return a fresh 1-hour signed URL for a Cloud Storage object URL
+
+    Returns None for other URLs, or when no service account credentials are available.
+    """
+    _, netloc, path, _, _ = urlsplit(image_url)
+    bucket_name, _, blob_name = path.lstrip("/").partition("/")
+    if netloc != GCS_HOST or not blob_name:
+        return None
+
+    try:
+        from pathlib import Path
+        from google.cloud import storage
+        from datetime import timedelta
+
+        if not Path(credentials_path).exists():
+            return None
+        credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        client = storage.Client(credentials=credentials)
+        blob = client.bucket(bucket_name).blob(unquote(blob_name))
+        return blob.generate_signed_url(expiration=timedelta(hours=1), method="GET")
+    except Exception as e:
+        print(f"⚠️  Could not generate signed URL: {str(e)}")
+        return None
+
 
 class InitializeGoogleCloudServices:
     def __init__(self):
@@ -81,6 +119,11 @@ class DishSuggestionService(InitializeGoogleCloudServices):
         if not self.gemini_model:
             raise Exception("Gemini model not initialized. Please set GEMINI_API_KEY or configure Google Cloud credentials.")
         
+        cache_key = result_cache.key("identify_dish", description)
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            return cached
+        
         prompt = f"""
             You are a food expert. Identify the exact dish name from the user's description.
 
@@ -108,7 +151,8 @@ class DishSuggestionService(InitializeGoogleCloudServices):
 
         response_text = ""
         try:
-            response = self.gemini_model.generate_content(prompt)
+            # Gemini calls block, so keep them off the event loop serving other requests
+            response = await asyncio.to_thread(self.gemini_model.generate_content, prompt)
 
             # parse response
             response_text = response.text.strip()
@@ -121,6 +165,7 @@ class DishSuggestionService(InitializeGoogleCloudServices):
             response_text = response_text.strip()
             
             result = json.loads(response_text)
+            await asyncio.to_thread(result_cache.set, cache_key, result)
             return result
         except json.JSONDecodeError as e:
             # extract dish name
@@ -147,6 +192,11 @@ class DishSuggestionService(InitializeGoogleCloudServices):
         if not self.gemini_model:
             raise Exception("Gemini model not initialized. Please set GEMINI_API_KEY or configure Google Cloud credentials.")
         
+        cache_key = result_cache.key("restaurant_recommendations", dish_name, location)
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            return [RestaurantRecommendation(**rest) for rest in cached]
+        
         prompt = f"""
             You are a restaurant recommendation expert. Find two REAL establishments (restaurants or cafes) in {location if location else "the local area"} where the dish "{dish_name}" can be found.
 
@@ -177,7 +227,7 @@ class DishSuggestionService(InitializeGoogleCloudServices):
 
         response_text = ""
         try:
-            response = self.gemini_model.generate_content(prompt)
+            response = await asyncio.to_thread(self.gemini_model.generate_content, prompt)
             response_text = response.text.strip()
 
             if response_text.startswith("```json"):
@@ -195,11 +245,12 @@ class DishSuggestionService(InitializeGoogleCloudServices):
                 response_text = response_text[start:end]
             
             result = json.loads(response_text)
-            restaurants = result.get("establishments", [])
-            
-            return [
-                RestaurantRecommendation(**rest) for rest in restaurants
+            restaurants = [
+                RestaurantRecommendation(**rest) for rest in result.get("establishments", [])
             ]
+            await asyncio.to_thread(result_cache.set, cache_key, [rest.model_dump() for rest in restaurants])
+            
+            return restaurants
         except json.JSONDecodeError as e:
             print(f"JSON parsing error: {e}, response: {response_text}")
             
@@ -233,32 +284,20 @@ class DishAnalysisService(InitializeGoogleCloudServices):
         # call parent class to init google cloud services
         super().__init__()
     
-    async def _analyze_image_with_vision(self, image_url: Optional[str] = None, image_base64: Optional[str] = None) -> str:
+    async def _analyze_image_with_vision(self, image_bytes: bytes, reservation) -> str:
         """Analyze image using Google Cloud Vision API and return description"""
         if not self.vision_client:
             return ""
         
         try:
-            image = None
-            if image_url:
-                # download image from URL
-                response = requests.get(image_url, timeout=10)
-                if response.status_code == 200:
-                    image = vision.Image(content=response.content)
-            elif image_base64:
-                # decode base64 image
-                image_data = base64.b64decode(image_base64)
-                image = vision.Image(content=image_data)
-            
-            if not image:
-                return ""
+            image = vision.Image(content=image_bytes)
             
             # perform label detection
-            label_response = self.vision_client.label_detection(image=image)
+            label_response = await reservation.to_thread(self.vision_client.label_detection, image=image)
             labels = [label.description for label in label_response.label_annotations[:10]]
             
             # perform text detection
-            text_response = self.vision_client.text_detection(image=image)
+            text_response = await reservation.to_thread(self.vision_client.text_detection, image=image)
             texts = [text.description for text in text_response.text_annotations[:5]] if text_response.text_annotations else []
             
             vision_description = f"Detected labels: {', '.join(labels)}"
@@ -270,6 +309,147 @@ class DishAnalysisService(InitializeGoogleCloudServices):
             print(f"Error analyzing image with Vision API: {e}")
             return ""
     
+    async def _load_image_bytes(self, image_url: Optional[str] = None, image_base64: Optional[str] = None):
+        """Download or decode the raw image bytes after reserving the request's peak memory
+        
+        The reservation covers the raw bytes, Vision's copy of them and a downscaled
+        decode. Returns the bytes and the reservation; the caller releases it.
+        """
+        max_bytes = image_budget.max_image_bytes
+        
+        if image_url:
+            try:
+                response = await asyncio.to_thread(requests.get, image_url, timeout=10, stream=True)
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"Failed to load image from URL: {str(e)}. URL: {image_url}")
+            
+            reservation = None
+            loaded = False
+            try:
+                # check HTTP status code
+                if response.status_code != 200:
+                    raise Exception(
+                        f"Failed to fetch image from URL: HTTP {response.status_code} - {response.reason}. "
+                        f"URL: {image_url}"
+                    )
+                
+                # reserve for the announced size, or the per-image maximum if the server does not say
+                content_length = response.headers.get("Content-Length", "")
+                expected_bytes = int(content_length) if content_length.isdigit() else max_bytes
+                if expected_bytes > max_bytes:
+                    raise ImageTooLarge(
+                        f"Image too large: {expected_bytes} bytes exceeds the {max_bytes} byte limit. URL: {image_url}"
+                    )
+                reservation = await image_budget.acquire(2 * expected_bytes + IMAGE_PIXEL_BYTES, "image download")
+                
+                chunks = response.iter_content(chunk_size=64 * 1024)
+                body = []
+                received = await reservation.to_thread(self._read_image_body, chunks, body, expected_bytes)
+                if received > expected_bytes and expected_bytes < max_bytes:
+                    # Content-Length can be wrong, or describe a compressed body
+                    await reservation.grow(2 * max_bytes + IMAGE_PIXEL_BYTES)
+                    received = await reservation.to_thread(self._read_image_body, chunks, body, max_bytes)
+                if received > max_bytes:
+                    raise ImageTooLarge(
+                        f"Image too large: more than {max_bytes} bytes received. URL: {image_url}"
+                    )
+                image_bytes = b"".join(body)
+                del body
+                
+                reservation.resize(2 * len(image_bytes) + IMAGE_PIXEL_BYTES)
+                loaded = True
+                return image_bytes, reservation
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"Failed to load image from URL: {str(e)}. URL: {image_url}")
+            finally:
+                # also reached on cancellation, which `except Exception` would miss;
+                # a download still running in its thread keeps the response open
+                if reservation:
+                    reservation.when_idle(response.close)
+                    if not loaded:
+                        reservation.release()
+                else:
+                    response.close()
+        
+        # base64 decodes to at most 3/4 of its length
+        expected_bytes = len(image_base64) * 3 // 4
+        if expected_bytes > max_bytes:
+            raise ImageTooLarge(f"Image too large: {expected_bytes} bytes exceeds the {max_bytes} byte limit")
+        reservation = await image_budget.acquire(2 * expected_bytes + IMAGE_PIXEL_BYTES, "base64 image")
+        loaded = False
+        try:
+            image_data = await reservation.to_thread(base64.b64decode, image_base64)
+            reservation.resize(2 * len(image_data) + IMAGE_PIXEL_BYTES)
+            loaded = True
+            return image_data, reservation
+        except Exception as decode_error:
+            raise Exception(
+                f"Failed to decode base64 image: Invalid base64 format. Error: {str(decode_error)}"
+            )
+        finally:
+            if not loaded:
+                reservation.release()
+    
+    @staticmethod
+    def _read_image_body(chunks, body: List[bytes], limit: int) -> int:
+        """Append streamed chunks to body until it exceeds limit bytes or ends; return its size
+        
+        Stopping at the limit lets the caller grow its reservation, or reject an
+        oversized image, before any more of it is buffered.
+        """
+        received = sum(len(chunk) for chunk in body)
+        for chunk in chunks:
+            body.append(chunk)
+            received += len(chunk)
+            if received > limit:
+                break
+        return received
+    
+    async def _decode_image(self, image_bytes: bytes, reservation, image_url: Optional[str] = None):
+        """Decode image pixels within the request's reservation, downscaling to IMAGE_MAX_DIMENSION"""
+        import PIL.Image
+        import io
+        
+        def parse_error(img_error):
+            if image_url:
+                return Exception(
+                    f"Failed to parse image from URL. The URL returned data but it's not a valid image format. "
+                    f"Error: {str(img_error)}. URL: {image_url}"
+                )
+            return Exception(
+                f"Failed to parse base64 image: The data is not a valid image format. "
+                f"Error: {str(img_error)}"
+            )
+        
+        # closing the buffer after loading lets the raw bytes be freed independently of the image
+        with io.BytesIO(image_bytes) as buffer:
+            try:
+                img = PIL.Image.open(buffer)
+                # JPEG can decode directly at a reduced scale, so full-size pixels are never allocated
+                img.draft(img.mode, (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            except Exception as img_error:
+                raise parse_error(img_error)
+            
+            try:
+                # other formats decode at full size and are downscaled afterwards
+                needs_thumbnail = max(img.size) > IMAGE_MAX_DIMENSION
+                await reservation.grow(
+                    len(image_bytes)
+                    + img.width * img.height * len(img.getbands())
+                    + (IMAGE_PIXEL_BYTES if needs_thumbnail else 0)
+                )
+                # decoding is CPU-bound; the budget itself is only touched on the event loop
+                await reservation.to_thread(img.load)
+                await reservation.to_thread(img.thumbnail, (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            except ImageBudgetExceeded:
+                img.close()
+                raise
+            except Exception as img_error:
+                img.close()
+                raise parse_error(img_error)
+        
+        return img
+    
     async def analyze_dish(
         self,
         title: str = "",
@@ -301,71 +481,58 @@ class DishAnalysisService(InitializeGoogleCloudServices):
         if not image_url and not image_base64:
             raise Exception("Either image_url or image_base64 must be provided")
         
-        # analyze image with Vision API
-        vision_analysis = ""
-        if image_url or image_base64:
-            vision_analysis = await self._analyze_image_with_vision(image_url, image_base64)
-        
-        # prepare image for Gemini
-        image_parts = []
-        if image_url:
-            try:
-                response = requests.get(image_url, timeout=10)
-                # check HTTP status code
-                if response.status_code != 200:
-                    raise Exception(
-                        f"Failed to fetch image from URL: HTTP {response.status_code} - {response.reason}. "
-                        f"URL: {image_url}"
-                    )
-                
-                # try to open and validate the image
-                import PIL.Image
-                import io
-                try:
-                    img = PIL.Image.open(io.BytesIO(response.content))
-                    image_parts.append(img)
-                except Exception as img_error:
-                    raise Exception(
-                        f"Failed to parse image from URL. The URL returned data but it's not a valid image format. "
-                        f"Error: {str(img_error)}. URL: {image_url}"
-                    )
-            except requests.exceptions.RequestException as e:
-                raise Exception(f"Failed to load image from URL: {str(e)}. URL: {image_url}")
-            except Exception as e:
-                # re-raise if it's already our formatted exception
-                if "Failed to fetch image from URL" in str(e) or "Failed to parse image from URL" in str(e):
-                    raise
-                raise Exception(f"Failed to load image from URL: {str(e)}. URL: {image_url}")
-        elif image_base64:
-            try:
-                import PIL.Image
-                import io
-                # decode base64
-                try:
-                    image_data = base64.b64decode(image_base64)
-                except Exception as decode_error:
-                    raise Exception(
-                        f"Failed to decode base64 image: Invalid base64 format. Error: {str(decode_error)}"
-                    )
-                
-                # try to open and validate the image
-                try:
-                    img = PIL.Image.open(io.BytesIO(image_data))
-                    image_parts.append(img)
-                except Exception as img_error:
-                    raise Exception(
-                        f"Failed to parse base64 image: The data is not a valid image format. "
-                        f"Error: {str(img_error)}"
-                    )
-            except Exception as e:
-                # re-raise if it's already our formatted exception
-                if "Failed to decode base64 image" in str(e) or "Failed to parse base64 image" in str(e):
-                    raise
-                raise Exception(f"Failed to process base64 image: {str(e)}")
-        
-        if not image_parts:
-            raise Exception("Failed to load image for analysis: No image was successfully loaded")
+        cache_key = result_cache.key(
+            "analyze_dish",
+            title,
+            description,
+            image_key(image_url, image_base64),
+            user_preferences,
+            known_dishes
+        )
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            cached["similar_dishes"] = [SimilarDish(**sd) for sd in cached["similar_dishes"]]
+            return cached
         
+        # load the image once and reuse it for Vision and Gemini; the reservation
+        # shrinks as soon as each stage is done with its buffers
+        image_bytes, reservation = await self._load_image_bytes(image_url, image_base64)
+        img = None
+        try:
+            # analyze image with Vision API
+            vision_analysis = await self._analyze_image_with_vision(image_bytes, reservation)
+            # Vision's copy of the payload is gone once its calls return
+            reservation.resize(len(image_bytes) + IMAGE_PIXEL_BYTES)
+            
+            # prepare image for Gemini
+            img = await self._decode_image(image_bytes, reservation, image_url)
+            # only the decoded pixels are needed from here on
+            del image_bytes
+            reservation.resize(img.width * img.height * len(img.getbands()))
+            
+            return await reservation.to_thread(
+                self._generate_analysis,
+                img, title, description, vision_analysis, user_preferences, known_dishes, cache_key
+            )
+        finally:
+            # if the request was cancelled, a worker thread may still be reading the pixels
+            if img:
+                reservation.when_idle(img.close)
+            reservation.release()
+    
+    def _generate_analysis(
+        self,
+        img,
+        title: str,
+        description: str,
+        vision_analysis: str,
+        user_preferences: Optional[List[str]] = None,
+        known_dishes: Optional[List[str]] = None,
+        cache_key: Optional[str] = None
+    ):
+        """Ask Gemini for the dish analysis of a decoded image, caching successful answers under cache_key"""
+        image_parts = [img]
+
         # build prompt
         preferences_text = ""
         if user_preferences:
@@ -441,7 +608,7 @@ Important:
                     similarity_reason=sd.get("similarity_reason", "")
                 ))
             
-            return {
+            analysis = {
                 "dish_name": result.get("dish_name", "Unknown Dish"),
                 "dish_description": result.get("dish_description", ""),
                 "taste_profile": result.get("taste_profile", ""),
@@ -454,6 +621,12 @@ Important:
                 "ingredient_origins": result.get("ingredient_origins"),
                 "warnings": result.get("warnings", [])
             }
+            if cache_key:
+                result_cache.set(
+                    cache_key,
+                    {**analysis, "similar_dishes": [sd.model_dump() for sd in similar_dishes]}
+                )
+            return analysis
         except json.JSONDecodeError as e:
             print(f"JSON parsing error: {e}, response: {response_text}")
             # return default response
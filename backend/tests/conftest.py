@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend modules are imported by their top-level names, as in main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,405 @@
+import io
+import time
+import base64
+import random
+import asyncio
+import threading
+
+import PIL.Image
+import pytest
+
+import image_budget as image_budget_module
+import services
+from image_budget import ImageMemoryBudget, ImageBudgetExceeded, ImageTooLarge
+
+MB = 1024 * 1024
+
+
+def _encode(img, fmt: str) -> str:
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture(scope="module")
+def large_jpeg_base64():
+    # noise keeps the JPEG large (several MB), like an unprocessed phone photo
+    return _encode(PIL.Image.effect_noise((3000, 2000), 64).convert("RGB"), "JPEG")
+
+
+@pytest.fixture
+def analysis_service():
+    # skip Google client initialization, the image helpers do not use it
+    return services.DishAnalysisService.__new__(services.DishAnalysisService)
+
+
+def test_concurrent_reservations_stay_within_capacity():
+    budget = ImageMemoryBudget(256 * MB, 20 * MB, max_wait_seconds=30)
+    rng = random.Random(0)
+
+    async def request():
+        raw = rng.randint(1, 20) * MB
+        reservation = await budget.acquire(2 * raw + 16 * MB)
+        try:
+            await asyncio.sleep(rng.random() * 0.01)
+            reservation.resize(raw + 16 * MB)
+            # decoding some images needs more than was reserved up front
+            await reservation.grow(raw + rng.randint(1, 40) * MB)
+            await asyncio.sleep(0)
+            reservation.resize(min(reservation.nbytes, rng.randint(1, 16) * MB))
+            await asyncio.sleep(rng.random() * 0.01)
+        finally:
+            reservation.release()
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(300)))
+
+    asyncio.run(main())
+    assert budget.peak_bytes <= budget.capacity_bytes
+    assert budget.in_use_bytes == 0
+    assert budget.waits > 0
+    assert budget.stats()["queued"] == 0
+
+
+def test_stress_many_concurrent_large_images(monkeypatch, analysis_service, large_jpeg_base64):
+    budget = ImageMemoryBudget(96 * MB, 20 * MB, max_wait_seconds=60)
+    monkeypatch.setattr(services, "image_budget", budget)
+    decoded_sizes = []
+
+    async def request():
+        image_bytes, reservation = await analysis_service._load_image_bytes(image_base64=large_jpeg_base64)
+        img = None
+        try:
+            # stand-in for the Vision call
+            await asyncio.sleep(0.005)
+            reservation.resize(len(image_bytes) + services.IMAGE_PIXEL_BYTES)
+            img = await analysis_service._decode_image(image_bytes, reservation)
+            del image_bytes
+            reservation.resize(img.width * img.height * len(img.getbands()))
+            assert budget.in_use_bytes <= budget.capacity_bytes
+            # stand-in for the Gemini call
+            await asyncio.sleep(0.005)
+            decoded_sizes.append(img.size)
+        finally:
+            if img:
+                img.close()
+            reservation.release()
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(40)))
+
+    asyncio.run(main())
+    assert len(decoded_sizes) == 40
+    assert all(max(size) <= services.IMAGE_MAX_DIMENSION for size in decoded_sizes)
+    assert budget.peak_bytes <= budget.capacity_bytes
+    assert budget.in_use_bytes == 0
+    assert budget.waits > 0
+
+
+def test_rejects_after_wait_timeout():
+    budget = ImageMemoryBudget(100, 100, max_wait_seconds=0.1)
+
+    async def main():
+        holder = await budget.acquire(100)
+        start = time.monotonic()
+        with pytest.raises(ImageBudgetExceeded) as excinfo:
+            await budget.acquire(50)
+        assert not isinstance(excinfo.value, ImageTooLarge)
+        assert time.monotonic() - start >= 0.1
+        holder.release()
+
+    asyncio.run(main())
+    assert budget.rejections == 1
+    assert budget.in_use_bytes == 0
+    assert budget.stats()["queued"] == 0
+
+
+def test_images_that_can_never_fit_are_too_large():
+    budget = ImageMemoryBudget(100, 100, max_wait_seconds=0.1)
+
+    async def main():
+        with pytest.raises(ImageTooLarge):
+            await budget.acquire(101)
+
+        reservation = await budget.acquire(20)
+        with pytest.raises(ImageTooLarge):
+            await reservation.grow(101)
+        assert reservation.nbytes == 20
+        reservation.release()
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+
+
+def test_decode_larger_than_budget_is_too_large(monkeypatch, analysis_service):
+    budget = ImageMemoryBudget(10 * MB, 10 * MB, max_wait_seconds=0.1)
+    monkeypatch.setattr(services, "image_budget", budget)
+    monkeypatch.setattr(services, "IMAGE_PIXEL_BYTES", MB)
+    # a flat PNG is tiny on the wire but 12 MB once decoded
+    png_base64 = _encode(PIL.Image.new("RGB", (2000, 2000), "white"), "PNG")
+
+    async def main():
+        image_bytes, reservation = await analysis_service._load_image_bytes(image_base64=png_base64)
+        try:
+            with pytest.raises(ImageTooLarge):
+                await analysis_service._decode_image(image_bytes, reservation)
+        finally:
+            reservation.release()
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+
+
+def test_grant_at_timeout_is_not_leaked(monkeypatch):
+    budget = ImageMemoryBudget(10, 10, max_wait_seconds=1)
+
+    async def main():
+        holder = await budget.acquire(10)
+
+        # what wait_for does on Python 3.12+ when the grant and the timeout land together
+        async def grant_then_time_out(future, timeout):
+            holder.release()
+            assert future.done() and not future.cancelled()
+            raise asyncio.TimeoutError
+
+        monkeypatch.setattr(image_budget_module.asyncio, "wait_for", grant_then_time_out)
+        reservation = await budget.acquire(10)
+        monkeypatch.undo()
+        assert budget.in_use_bytes == 10
+        reservation.release()
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+    assert budget.rejections == 0
+
+
+def test_release_at_deadline_never_leaks():
+    budget = ImageMemoryBudget(10, 10, max_wait_seconds=0.01)
+
+    async def trial():
+        holder = await budget.acquire(10)
+        loop = asyncio.get_running_loop()
+        loop.call_at(loop.time() + budget.max_wait_seconds, holder.release)
+        try:
+            reservation = await budget.acquire(10)
+            reservation.release()
+        except ImageBudgetExceeded:
+            pass
+        await asyncio.sleep(0.02)
+        holder.release()
+        assert budget.in_use_bytes == 0
+
+    async def main():
+        for _ in range(50):
+            await trial()
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiters_do_not_leak():
+    budget = ImageMemoryBudget(10, 10, max_wait_seconds=5)
+
+    async def main():
+        holder = await budget.acquire(10)
+
+        # cancelled while still queued: the next waiter must still be served
+        queued = asyncio.create_task(budget.acquire(10))
+        behind = asyncio.create_task(budget.acquire(5))
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.sleep(0)
+        holder.release()
+        (await behind).release()
+
+        # cancelled after being granted, before it could resume
+        holder = await budget.acquire(10)
+        granted = asyncio.create_task(budget.acquire(10))
+        await asyncio.sleep(0)
+        holder.release()
+        granted.cancel()
+        # depending on the Python version the grant wins or the cancellation does
+        try:
+            (await granted).release()
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+    assert budget.stats()["queued"] == 0
+
+
+class _StalledResponse:
+    """Streaming response whose body arrives only once `resume` is set"""
+
+    def __init__(self, body: bytes, resume: threading.Event, content_length=None):
+        self.status_code = 200
+        self.reason = "OK"
+        self.headers = {"Content-Length": str(len(body) if content_length is None else content_length)}
+        self.body = body
+        self.resume = resume
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        self.resume.wait(5)
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+async def _cancel_while_stalled(load, started: threading.Event, resume: threading.Event, budget):
+    task = asyncio.create_task(load)
+    while not started.is_set():
+        await asyncio.sleep(0.001)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # the worker thread still holds the bytes, so they stay reserved until it ends
+    assert budget.in_use_bytes > 0
+    resume.set()
+    for _ in range(500):
+        if budget.in_use_bytes == 0:
+            break
+        await asyncio.sleep(0.01)
+
+
+def test_cancelled_download_does_not_leak(monkeypatch, analysis_service):
+    budget = ImageMemoryBudget(64 * MB, 20 * MB)
+    monkeypatch.setattr(services, "image_budget", budget)
+    started, resume = threading.Event(), threading.Event()
+    response = _StalledResponse(b"x" * MB, resume)
+
+    def stalled_get(url, **kwargs):
+        started.set()
+        return response
+
+    monkeypatch.setattr(services.requests, "get", stalled_get)
+    asyncio.run(_cancel_while_stalled(
+        analysis_service._load_image_bytes(image_url="https://example.com/dish.jpeg"),
+        started, resume, budget
+    ))
+    assert budget.in_use_bytes == 0
+    assert response.closed
+
+
+def test_body_longer_than_announced_grows_the_reservation(monkeypatch, analysis_service):
+    budget = ImageMemoryBudget(64 * MB, 4 * MB)
+    monkeypatch.setattr(services, "image_budget", budget)
+    resume = threading.Event()
+    resume.set()
+
+    async def load(body, content_length):
+        response = _StalledResponse(body, resume, content_length)
+        monkeypatch.setattr(services.requests, "get", lambda url, **kwargs: response)
+        return await analysis_service._load_image_bytes(image_url="https://example.com/dish.jpeg")
+
+    async def main():
+        # e.g. a gzip-encoded response announces its compressed length
+        image_bytes, reservation = await load(b"x" * (3 * MB), MB)
+        assert len(image_bytes) == 3 * MB
+        assert reservation.nbytes == 2 * len(image_bytes) + services.IMAGE_PIXEL_BYTES
+        reservation.release()
+
+        with pytest.raises(ImageTooLarge):
+            await load(b"x" * (5 * MB), MB)
+        with pytest.raises(ImageTooLarge):
+            await load(b"x" * (5 * MB), "")
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+
+
+def test_cancelled_base64_decode_does_not_leak(monkeypatch, analysis_service):
+    budget = ImageMemoryBudget(64 * MB, 20 * MB)
+    monkeypatch.setattr(services, "image_budget", budget)
+    started, resume = threading.Event(), threading.Event()
+    b64decode = base64.b64decode
+
+    def stalled_b64decode(data):
+        started.set()
+        resume.wait(5)
+        return b64decode(data)
+
+    monkeypatch.setattr(services.base64, "b64decode", stalled_b64decode)
+    asyncio.run(_cancel_while_stalled(
+        analysis_service._load_image_bytes(image_base64=base64.b64encode(b"x" * MB).decode()),
+        started, resume, budget
+    ))
+    assert budget.in_use_bytes == 0
+
+
+def test_cancelled_request_keeps_memory_until_its_thread_ends():
+    budget = ImageMemoryBudget(100, 100)
+    started, resume = threading.Event(), threading.Event()
+    closed = []
+
+    def stalled_work():
+        started.set()
+        resume.wait(5)
+
+    async def request():
+        reservation = await budget.acquire(100)
+        try:
+            await reservation.to_thread(stalled_work)
+        finally:
+            reservation.when_idle(lambda: closed.append(True))
+            reservation.release()
+
+    async def main():
+        await _cancel_while_stalled(request(), started, resume, budget)
+        assert closed == [True]
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+
+
+def test_growing_requests_wait_for_memory_instead_of_failing():
+    budget = ImageMemoryBudget(100, 100, max_wait_seconds=5)
+
+    async def main():
+        first = await budget.acquire(60)
+        second = await budget.acquire(40)
+        # both want to grow; the first waits for the second to finish
+        growing = asyncio.create_task(first.grow(90))
+        await asyncio.sleep(0)
+        # a new request must not overtake the growing one
+        newcomer = asyncio.create_task(budget.acquire(20))
+        await asyncio.sleep(0)
+        second.release()
+        await growing
+        assert first.nbytes == 90
+        assert not newcomer.done()
+        first.release()
+        (await newcomer).release()
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+    assert budget.rejections == 0
+
+
+def test_deadlocked_growers_are_rejected():
+    budget = ImageMemoryBudget(100, 100, max_wait_seconds=5)
+
+    async def main():
+        first = await budget.acquire(50)
+        second = await budget.acquire(50)
+
+        async def grow_or_give_up(reservation):
+            try:
+                await reservation.grow(80)
+                return True
+            except ImageBudgetExceeded:
+                return False
+            finally:
+                reservation.release()
+
+        start = time.monotonic()
+        results = await asyncio.gather(grow_or_give_up(first), grow_or_give_up(second))
+        # one is rejected at once instead of both waiting out the timeout
+        assert time.monotonic() - start < 1
+        assert sorted(results) == [False, True]
+
+    asyncio.run(main())
+    assert budget.in_use_bytes == 0
+    assert budget.rejections == 1
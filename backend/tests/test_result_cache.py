@@ -0,0 +1,66 @@
+import result_cache as result_cache_module
+from result_cache import ResultCache, image_key
+
+
+def test_keys_ignore_case_whitespace_and_list_order():
+    assert ResultCache.key("identify_dish", "  Spicy   Ramen ") == ResultCache.key("identify_dish", "spicy ramen")
+    assert ResultCache.key("analyze_dish", ["vegan", "nut-free"]) == ResultCache.key("analyze_dish", ["Nut-free", "vegan"])
+    assert ResultCache.key("restaurant_recommendations", "ramen", None) == ResultCache.key("restaurant_recommendations", "ramen", "")
+    assert ResultCache.key("identify_dish", "ramen") != ResultCache.key("analyze_dish", "ramen")
+    assert ResultCache.key("identify_dish", "ramen") != ResultCache.key("identify_dish", "udon")
+
+
+def test_image_key_drops_only_signing_parameters():
+    base = "https://storage.googleapis.com/bucket/menu.jpeg"
+    v4 = (
+        f"{base}?X-Goog-Algorithm=GOOG4-RSA-SHA256&X-Goog-Credential=abc&X-Goog-Date=20250101T000000Z"
+        "&X-Goog-Expires=3600&X-Goog-SignedHeaders=host&X-Goog-Signature=deadbeef"
+    )
+    v2 = f"{base}?GoogleAccessId=svc&Expires=1700000000&Signature=c2ln#fragment"
+    assert image_key(v4) == base
+    assert image_key(v2) == base
+
+    # parameters that select a different object must stay part of the key
+    assert image_key(f"{base}?id=1&Signature=a") != image_key(f"{base}?id=2&Signature=a")
+    assert image_key(f"{base}?generation=7&X-Goog-Signature=a") == f"{base}?generation=7"
+
+
+def test_image_key_for_inline_images():
+    assert image_key(image_base64="aGVsbG8=") == image_key(image_base64="aGVsbG8=")
+    assert image_key(image_base64="aGVsbG8=") != image_key(image_base64="d29ybGQ=")
+    assert image_key() == ""
+
+
+def test_round_trip_and_counters(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60)
+    key = cache.key("identify_dish", "ramen")
+    assert cache.get(key) is None
+    cache.set(key, {"dish_name": "Ramen"})
+    assert cache.get(key) == {"dish_name": "Ramen"}
+    assert cache.contains(key)
+
+    stats = cache.stats()
+    assert stats["entries"] == {"identify_dish": 1}
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache_module.time, "time", lambda: now[0])
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60)
+    key = cache.key("identify_dish", "ramen")
+    cache.set(key, {"dish_name": "Ramen"})
+
+    now[0] += 60
+    assert cache.get(key) == {"dish_name": "Ramen"}
+    now[0] += 1
+    assert cache.get(key) is None
+    assert not cache.contains(key)
+    assert cache.stats()["entries"] == {}
+
+
+def test_results_survive_a_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    key = ResultCache.key("identify_dish", "ramen")
+    ResultCache(path, ttl_seconds=60).set(key, ["persisted"])
+    assert ResultCache(path, ttl_seconds=60).get(key) == ["persisted"]
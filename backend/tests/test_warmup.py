@@ -0,0 +1,180 @@
+import json
+import asyncio
+
+import pytest
+
+import warmup
+from result_cache import ResultCache
+from warmup import RequestLog, mine_popular_queries, split_sample, warm_up
+
+SIGNED = "https://storage.googleapis.com/bucket/menu.jpeg?X-Goog-Date={}&X-Goog-Signature={}"
+OBJECT_URL = "https://storage.googleapis.com/bucket/menu.jpeg"
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=3600)
+    monkeypatch.setattr(warmup, "result_cache", cache)
+    return cache
+
+
+class StubDishService:
+    """Caches results under the same keys as DishSuggestionService"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = []
+
+    async def identify_dish_from_description(self, description):
+        self.calls.append(description)
+        self.cache.set(self.cache.key("identify_dish", description), {"dish_name": description})
+
+    async def get_restaurant_recommendations(self, dish_name, location=None):
+        self.calls.append((dish_name, location))
+        if dish_name == "unknown":
+            raise RuntimeError("no restaurants")
+        self.cache.set(self.cache.key("restaurant_recommendations", dish_name, location), [])
+
+
+class StubAnalysisService:
+    def __init__(self, cache):
+        self.cache = cache
+        self.image_urls = []
+
+    async def analyze_dish(self, title, image_url=None, image_base64=None, description="",
+                           user_preferences=None, known_dishes=None):
+        self.image_urls.append(image_url)
+        self.cache.set(
+            warmup._menu_image_key({"title": title, "description": description, "image_url": image_url}),
+            {"title": title}
+        )
+
+
+def test_mine_popular_queries_ranks_and_groups_signed_urls():
+    entries = [
+        {"kind": "recognize", "description": "spicy noodles", "dish_name": "Ramen", "location": "Helsinki"},
+        {"kind": "recognize", "description": "spicy noodles", "dish_name": "Ramen", "location": "Helsinki"},
+        {"kind": "recognize", "description": "rice rolls", "dish_name": "Sushi", "location": None},
+        {"kind": "recognize", "description": ""},
+        {"kind": "analyze", "title": "Menu", "description": "", "image_url": SIGNED.format(1, "a")},
+        {"kind": "analyze", "title": "Menu", "description": "", "image_url": SIGNED.format(2, "b")},
+        {"kind": "analyze", "title": "Other", "description": "", "image_url": OBJECT_URL + "?id=2"},
+        {"kind": "unknown"},
+    ]
+    queries = mine_popular_queries(entries, top_n=2)
+
+    assert queries["descriptions"] == ["spicy noodles", "rice rolls"]
+    assert queries["dish_locations"] == [
+        {"dish_name": "Ramen", "location": "Helsinki"},
+        {"dish_name": "Sushi", "location": None},
+    ]
+    # both signed URLs are the same object, logged with an unsigned identity
+    assert queries["menu_images"] == [
+        {"title": "Menu", "description": "", "image_url": OBJECT_URL},
+        {"title": "Other", "description": "", "image_url": OBJECT_URL + "?id=2"},
+    ]
+    assert len(mine_popular_queries(entries, top_n=1)["menu_images"]) == 1
+
+
+def test_hit_rate_is_measured_on_a_held_out_sample(cache):
+    dish_service = StubDishService(cache)
+    entries = [{"kind": "recognize", "description": "spicy noodles"}] * 6 + [
+        {"kind": "recognize", "description": "spicy noodles"},
+        {"kind": "recognize", "description": "only asked recently"},
+    ]
+    mined, sample = split_sample(entries, 2)
+    assert mined == entries[:6]
+    assert sample == entries[6:]
+    queries = mine_popular_queries(mined)
+    # a query seen only in the sample is not mined, so it counts as a miss
+    assert queries["descriptions"] == ["spicy noodles"]
+
+    report = asyncio.run(warm_up(dish_service, None, queries, rate_per_second=0, sample=sample))
+    assert report["sample"] == {"sample_size": 2, "hits": 1, "hit_rate": 0.5}
+
+    # a short log keeps at least half of its entries for mining
+    assert split_sample(entries[:3], 500) == (entries[:2], entries[2:3])
+    assert split_sample([], 500) == ([], [])
+
+
+def test_request_log_rotates_and_reads_the_tail(tmp_path):
+    log = RequestLog(str(tmp_path / "requests.jsonl"), max_bytes=2000)
+    for i in range(100):
+        log.record("recognize", description=f"dish {i}")
+
+    assert (tmp_path / "requests.jsonl.1").exists()
+    assert (tmp_path / "requests.jsonl").stat().st_size <= 2000 + 100
+
+    recent = log.read(limit=30)
+    assert [entry["description"] for entry in recent] == [f"dish {i}" for i in range(70, 100)]
+    # with a large limit the rotated file fills in older entries, oldest first
+    descriptions = [entry["description"] for entry in log.read()]
+    assert descriptions[-1] == "dish 99"
+    assert descriptions == sorted(descriptions, key=lambda d: int(d.split()[1]))
+
+    with open(log.path, "a") as f:
+        f.write("not json\n")
+    assert log.read(limit=1) == []
+    assert RequestLog("").read() == []
+
+
+def test_warm_up_skips_cached_keys_and_reports_coverage(cache):
+    dish_service = StubDishService(cache)
+    analysis_service = StubAnalysisService(cache)
+    cache.set(cache.key("identify_dish", "spicy noodles"), {"dish_name": "Ramen"})
+    queries = {
+        "descriptions": ["spicy noodles", "rice rolls"],
+        "dish_locations": [{"dish_name": "Ramen", "location": "Helsinki"}, {"dish_name": "unknown"}],
+        "menu_images": [{"title": "Menu", "description": "", "image_url": OBJECT_URL}],
+    }
+    sample = [
+        {"kind": "recognize", "description": "Spicy  noodles", "dish_name": "ramen", "location": "helsinki"},
+        {"kind": "recognize", "description": "rice rolls", "dish_name": "unknown"},
+        {"kind": "recognize", "description": "never seen"},
+        {"kind": "analyze", "title": "Menu", "description": "", "image_url": SIGNED.format(3, "c")},
+    ]
+
+    report = asyncio.run(warm_up(
+        dish_service,
+        analysis_service,
+        queries,
+        rate_per_second=0,
+        sample=sample,
+        resolve_image_url=lambda url: url + "?X-Goog-Signature=fresh"
+    ))
+
+    assert "spicy noodles" not in dish_service.calls
+    assert report["replayed"] == 4
+    assert report["errors"] == ["no restaurants"]
+    assert analysis_service.image_urls == [OBJECT_URL + "?X-Goog-Signature=fresh"]
+    assert report["coverage"] == {
+        "descriptions": {"cached": 2, "total": 2},
+        "dish_locations": {"cached": 1, "total": 2},
+        "menu_images": {"cached": 1, "total": 1},
+    }
+    assert report["coverage_rate"] == 0.8
+    assert report["sample"] == {"sample_size": 4, "hits": 2, "hit_rate": 0.5}
+    json.dumps(report)
+
+    # a second run finds everything it can cache already cached
+    dish_service.calls.clear()
+    report = asyncio.run(warm_up(dish_service, analysis_service, queries, rate_per_second=0))
+    assert dish_service.calls == [("unknown", None)]
+    assert report["replayed"] == 1
+    assert report["sample"]["hit_rate"] is None
+
+
+def test_warm_up_respects_rate_per_second(cache):
+    dish_service = StubDishService(cache)
+    queries = {
+        "descriptions": [f"dish {i}" for i in range(4)],
+        "dish_locations": [],
+        "menu_images": [],
+    }
+    cache.set(cache.key("identify_dish", "dish 0"), {})
+
+    report = asyncio.run(warm_up(dish_service, None, queries, rate_per_second=20))
+
+    # three uncached calls are spaced 1/20 s apart; the cached one costs no slot
+    assert report["replayed"] == 3
+    assert 0.1 <= report["elapsed_seconds"] < 1
@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import Counter
+from typing import Callable, List, Optional
+from dotenv import load_dotenv
+from result_cache import result_cache, image_key
+
+# Load environment variables
+load_dotenv()
+
+
+class RequestLog:
+    """Append-only JSON lines log of served requests, mined by the cache warm-up
+
+    The log rotates to a single ".1" file once it reaches max_bytes, and only
+    its tail is read back. Like the result cache it is a per-instance file on
+    local disk: appends from several instances to one file on Cloud Storage
+    FUSE or NFS overwrite each other, so REQUEST_LOG_PATH must not point there.
+    Each instance therefore mines only the traffic it served itself, or the
+    curated CACHE_WARMUP_QUERIES_PATH file.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        # an empty REQUEST_LOG_PATH disables request logging
+        return cls(
+            os.getenv("REQUEST_LOG_PATH", "request_log.jsonl"),
+            max_bytes=int(float(os.getenv("REQUEST_LOG_MAX_MB", "10")) * 1024 * 1024)
+        )
+
+    def record(self, kind: str, **fields):
+        """Append an entry; blocking file I/O, so async callers run it in a thread"""
+        if not self.path:
+            return
+        entry = {"ts": time.time(), "kind": kind, **fields}
+        try:
+            with self._lock:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"Warning: failed to write request log: {e}")
+
+    def read(self, limit: int = 10000) -> List[dict]:
+        """Return the most recent entries, skipping lines that cannot be parsed"""
+        if not self.path:
+            return []
+        lines = _tail_lines(self.path, limit)
+        if len(lines) < limit:
+            lines = _tail_lines(self.path + ".1", limit - len(lines)) + lines
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return entries
+
+
+def _tail_lines(path: str, limit: int, block_size: int = 64 * 1024) -> List[bytes]:
+    """Read the last limit lines of a file without scanning it from the start"""
+    if limit <= 0 or not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b""
+        while end > 0 and data.count(b"\n") <= limit:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    lines = data.splitlines()
+    if end > 0:
+        # the first line may have been cut in half by the block boundary
+        lines = lines[1:]
+    return lines[-limit:]
+
+
+request_log = RequestLog.from_env()
+
+
+def mine_popular_queries(entries: List[dict], top_n: int = 20) -> dict:
+    """Pick the top_n descriptions, (dish, location) pairs and menu images from logged requests"""
+    descriptions = Counter()
+    dish_locations = Counter()
+    menu_images = Counter()
+    # signed URLs of the same image differ per request, so group by the image identity
+    latest_menu_image = {}
+    for entry in entries:
+        if entry.get("kind") == "recognize":
+            if entry.get("description"):
+                descriptions[entry["description"]] += 1
+            if entry.get("dish_name"):
+                dish_locations[(entry["dish_name"], entry.get("location"))] += 1
+        elif entry.get("kind") == "analyze" and entry.get("image_url"):
+            image = {
+                "title": entry.get("title", ""),
+                "description": entry.get("description", ""),
+                "image_url": image_key(entry["image_url"]),
+            }
+            key = _menu_image_key(image)
+            menu_images[key] += 1
+            latest_menu_image[key] = image
+
+    return {
+        "descriptions": [description for description, _ in descriptions.most_common(top_n)],
+        "dish_locations": [
+            {"dish_name": dish_name, "location": location}
+            for (dish_name, location), _ in dish_locations.most_common(top_n)
+        ],
+        "menu_images": [latest_menu_image[key] for key, _ in menu_images.most_common(top_n)],
+    }
+
+
+def split_sample(entries: List[dict], sample_size: int):
+    """Split logged entries into those to mine and a held-out recent sample
+
+    The hit rate is only meaningful on traffic the popular queries were not
+    mined from. At most half of a short log is held out, so it still has
+    something to mine.
+    """
+    holdout = min(sample_size, len(entries) // 2)
+    if holdout <= 0:
+        return entries, []
+    return entries[:-holdout], entries[-holdout:]
+
+
+def load_popular_queries(path: str, top_n: int = 20) -> dict:
+    """Read a curated popular-queries file with the same shape as mine_popular_queries"""
+    with open(path, encoding="utf-8") as f:
+        queries = json.load(f)
+    return {
+        "descriptions": queries.get("descriptions", [])[:top_n],
+        "dish_locations": queries.get("dish_locations", [])[:top_n],
+        "menu_images": queries.get("menu_images", [])[:top_n],
+    }
+
+
+def _description_key(description: str) -> str:
+    return result_cache.key("identify_dish", description)
+
+
+def _dish_location_key(dish_name: str, location: Optional[str]) -> str:
+    return result_cache.key("restaurant_recommendations", dish_name, location)
+
+
+def _menu_image_key(image: dict) -> str:
+    return result_cache.key(
+        "analyze_dish",
+        image.get("title", ""),
+        image.get("description", ""),
+        image_key(image.get("image_url"), image.get("image_base64")),
+        image.get("user_preferences"),
+        image.get("known_dishes")
+    )
+
+
+def measure_coverage(queries: dict) -> dict:
+    """Count how many of the popular queries of each kind are cached"""
+    coverage = {}
+    for name, key_for in (
+        ("descriptions", _description_key),
+        ("dish_locations", lambda pair: _dish_location_key(pair["dish_name"], pair.get("location"))),
+        ("menu_images", _menu_image_key),
+    ):
+        cached = sum(1 for query in queries[name] if result_cache.contains(key_for(query)))
+        coverage[name] = {"cached": cached, "total": len(queries[name])}
+    return coverage
+
+
+def measure_hit_rate(entries: List[dict]) -> dict:
+    """Replay logged requests against the cache and count how many would be served from it
+
+    A recognize request is a hit only if both its dish and its restaurant
+    lookups are cached. Nothing is sent to Gemini.
+    """
+    hits = 0
+    total = 0
+    for entry in entries:
+        if entry.get("kind") == "recognize" and entry.get("description"):
+            keys = [_description_key(entry["description"])]
+            if entry.get("dish_name"):
+                keys.append(_dish_location_key(entry["dish_name"], entry.get("location")))
+        elif entry.get("kind") == "analyze" and entry.get("image_url"):
+            keys = [_menu_image_key(entry)]
+        else:
+            continue
+        total += 1
+        if all(result_cache.contains(key) for key in keys):
+            hits += 1
+
+    return {
+        "sample_size": total,
+        "hits": hits,
+        "hit_rate": round(hits / total, 3) if total else None,
+    }
+
+
+async def warm_up(
+    dish_service,
+    analysis_service,
+    queries: dict,
+    rate_per_second: float = 0.5,
+    sample: Optional[List[dict]] = None,
+    resolve_image_url: Optional[Callable[[str], Optional[str]]] = None
+) -> dict:
+    """Replay popular queries through the services so their results land in the result cache
+
+    Queries that are already cached are skipped; the rest are sent at most
+    rate_per_second so warm-up does not compete with live traffic for quota.
+    Logged image URLs carry no signature, so resolve_image_url can re-sign
+    them (returning None keeps the URL as logged).
+    """
+    start_time = time.time()
+    interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+    loop = asyncio.get_running_loop()
+    next_call = loop.time()
+    replayed = 0
+    errors = []
+
+    async def replay(key, call):
+        nonlocal next_call, replayed
+        # SQLite reads can block, and warm-up shares the loop with live traffic
+        if await asyncio.to_thread(result_cache.contains, key):
+            return
+        now = loop.time()
+        if next_call > now:
+            await asyncio.sleep(next_call - now)
+        next_call = max(now, next_call) + interval
+        replayed += 1
+        try:
+            await call()
+        except Exception as e:
+            errors.append(str(e))
+
+    for description in queries["descriptions"]:
+        await replay(
+            _description_key(description),
+            lambda: dish_service.identify_dish_from_description(description)
+        )
+
+    for pair in queries["dish_locations"]:
+        await replay(
+            _dish_location_key(pair["dish_name"], pair.get("location")),
+            lambda: dish_service.get_restaurant_recommendations(pair["dish_name"], pair.get("location"))
+        )
+
+    async def analyze(image):
+        image_url = image.get("image_url")
+        if image_url and resolve_image_url:
+            # signing reads credentials from disk
+            image_url = await asyncio.to_thread(resolve_image_url, image_url) or image_url
+        return await analysis_service.analyze_dish(
+            title=image.get("title", ""),
+            image_url=image_url,
+            image_base64=image.get("image_base64"),
+            description=image.get("description", ""),
+            user_preferences=image.get("user_preferences"),
+            known_dishes=image.get("known_dishes")
+        )
+
+    for image in queries["menu_images"]:
+        await replay(_menu_image_key(image), lambda: analyze(image))
+
+    # coverage is measured after the replay, so entries cached by earlier runs count too
+    coverage = await asyncio.to_thread(measure_coverage, queries)
+    sample_report = await asyncio.to_thread(measure_hit_rate, sample or [])
+    cached_total = sum(c["cached"] for c in coverage.values())
+    queries_total = sum(c["total"] for c in coverage.values())
+
+    return {
+        "coverage": coverage,
+        "coverage_rate": round(cached_total / queries_total, 3) if queries_total else None,
+        "replayed": replayed,
+        "errors": errors,
+        "sample": sample_report,
+        "elapsed_seconds": round(time.time() - start_time, 2),
+    }
+
+
+def popular_queries_from_env(top_n: int, entries: List[dict]) -> dict:
+    """Use the curated file in CACHE_WARMUP_QUERIES_PATH if set, otherwise mine the logged entries"""
+    queries_path = os.getenv("CACHE_WARMUP_QUERIES_PATH")
+    if queries_path:
+        return load_popular_queries(queries_path, top_n)
+    return mine_popular_queries(entries, top_n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute popular Woltie results into the result cache")
+    parser.add_argument("--queries", help="curated popular-queries JSON file (default: mine the request log)")
+    parser.add_argument("--log", default=request_log.path, help="request log to mine and sample")
+    parser.add_argument("--top", type=int, default=20, help="number of queries per kind to warm up")
+    parser.add_argument("--rate", type=float, default=0.5, help="maximum Gemini calls per second")
+    parser.add_argument("--sample", type=int, default=500, help="recent logged requests held out of mining to measure hit rate")
+    args = parser.parse_args()
+
+    from services import DishSuggestionService, DishAnalysisService, sign_gcs_url
+
+    mined, sample = split_sample(RequestLog(args.log).read(), args.sample)
+    if args.queries:
+        queries = load_popular_queries(args.queries, args.top)
+    else:
+        queries = mine_popular_queries(mined, args.top)
+
+    report = asyncio.run(warm_up(
+        DishSuggestionService(),
+        DishAnalysisService(),
+        queries,
+        rate_per_second=args.rate,
+        sample=sample,
+        resolve_image_url=sign_gcs_url
+    ))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()